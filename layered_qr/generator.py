@@ -1,68 +1,93 @@
 import qrcode
-import random
 import os
+from concurrent.futures import ThreadPoolExecutor
 import math
-from PIL import Image, ImageDraw
+from functools import lru_cache
+import struct
+import zlib
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
 # --- Helper Functions ---
 
+@lru_cache(maxsize=41)
 def get_alignment_pattern_locations(version):
     """
     Calculate the center coordinates of alignment patterns for a given QR version.
+    Results are cached per version and returned as a read-only array.
     Args:
         version: The QR code version number (1 to 40).
     Returns:
-        A list of (row, col) tuples for the center coordinates. Returns empty list for version 1.
+        A (count, 2) int array of (row, col) center coordinates. Empty for version 1.
     """
-    # Alignment pattern positions are specified by the standard.
-    # This is a lookup table based on common versions.
-    # Source: e.g., https://www.thonky.com/qr-code-tutorial/alignment-pattern-locations
+    # Alignment pattern positions follow ISO/IEC 18004 (see e.g.
+    # https://www.thonky.com/qr-code-tutorial/alignment-pattern-locations):
+    # first is always 6, last is always matrix_size - 7 and the ones in between
+    # are spaced evenly with an even step, counted back from the last one.
     if version < 2:
-        return []
-    # Formula-based calculation is complex. Using a lookup for common versions.
-    # Pattern: First is always 6. Last is always matrix_size - 7. Others are spaced approx evenly.
-    positions = [
-        [], # Version 0 - Invalid
-        [], # Version 1 - No alignment patterns
-        [6, 18], # Version 2 (25x25)
-        [6, 22], # Version 3 (29x29)
-        [6, 26], # Version 4 (33x33)
-        [6, 30], # Version 5 (37x37)
-        [6, 34], # Version 6 (41x41)
-        # Version 7 (45x45) introduces multiple alignment patterns
-        [6, 22, 38],
-        [6, 24, 42], # V8 (49x49)
-        [6, 26, 46], # V9 (53x53)
-        [6, 28, 50], # V10 (57x57)
-        [6, 30, 54], # V11 (61x61)
-        [6, 32, 58], # V12 (65x65)
-        [6, 34, 62], # V13 (69x69)
-        # And so on... Add more as needed, or implement the formula.
-        # For higher versions, the number and spacing increase.
-        # Let's stop at V13 for this example lookup.
-    ]
-    if version >= len(positions):
-        # Approximation for higher versions (less accurate)
-        # A proper implementation would use the formula from the spec.
-        size = 4 * version + 17
-        num_patterns = math.ceil((version - 1) / 7) + 2 # Rough estimate
-        step = (size - 7 - 6) / (num_patterns - 1) if num_patterns > 1 else 0
-        coords = [6 + round(i * step) for i in range(num_patterns)]
-        print(f"Warning: Using estimated alignment pattern locations for version {version}. Accuracy not guaranteed.")
-        # Exclude potential overlaps with finder patterns (approximate check)
-        return [(r, c) for r in coords for c in coords if not ((r < 9 and c < 9) or (r < 9 and c > size - 10) or (r > size - 10 and c < 9))]
+        centers = np.empty((0, 2), dtype=int)
     else:
-        coords = positions[version]
-        # Generate all pairs, excluding those overlapping finder patterns (approx)
         size = 4 * version + 17
-        return [(r, c) for r in coords for c in coords if not ((r < 9 and c < 9) or (r < 9 and c > size - 10) or (r > size - 10 and c < 9))]
+        num_patterns = version // 7 + 2
+        # Version 32 is the only one where the spec deviates from the formula
+        step = 26 if version == 32 else 2 * math.ceil((size - 13) / (2 * (num_patterns - 1)))
+        coords = [6] + [size - 7 - (num_patterns - 2 - i) * step for i in range(num_patterns - 1)]
+        # Generate all pairs, excluding those overlapping finder patterns
+        centers = np.array(
+            [(r, c) for r in coords for c in coords if not ((r < 9 and c < 9) or (r < 9 and c > size - 10) or (r > size - 10 and c < 9))],
+            dtype=int
+        )
+    centers.flags.writeable = False
+    return centers
+
+
+@lru_cache(maxsize=41)
+def compute_structural_mask(size, version):
+    """
+    Approximates which modules are part of common structural elements for the whole matrix.
+    Paints the regions with NumPy slice assignments instead of testing each module.
+    WARNING: Still a heuristic, especially for high versions or unusual masks.
+    Results are cached per version and returned as a read-only array.
+    Args:
+        size: The width/height of the QR code matrix (e.g., 21 for version 1).
+        version: The QR code version number.
+    Returns:
+        A (size, size) boolean array, True where the module is likely structural.
+    """
+    mask = np.zeros((size, size), dtype=bool)
+
+    # 1. Finder Patterns + separators (8x8 corners)
+    mask[:8, :8] = True
+    mask[:8, -8:] = True
+    mask[-8:, :8] = True
+
+    # 2. Timing Patterns
+    mask[6, 8:size - 8] = True
+    mask[8:size - 8, 6] = True
+
+    # 3. Alignment Patterns (5x5 around each center)
+    for center_r, center_c in get_alignment_pattern_locations(version):
+        mask[center_r - 2:center_r + 3, center_c - 2:center_c + 3] = True
+
+    # 4. Format Information
+    mask[8, :9] = True
+    mask[:8, 8] = True
+    mask[8, -8:] = True
+    mask[-8:, 8] = True
+
+    # 5. Version Information (Only for version >= 7)
+    if version >= 7:
+        mask[:6, size - 11:size - 8] = True
+        mask[size - 11:size - 8, :6] = True
+
+    mask.flags.writeable = False
+    return mask
 
 
 def is_structural(row, col, size, version):
     """
-    Approximates if a module is part of common structural elements.
-    Includes improved checks for alignment patterns based on version.
-    WARNING: Still a heuristic, especially for high versions or unusual masks.
+    Scalar lookup into `compute_structural_mask`, kept for callers that test single modules.
     Args:
         row, col: Module coordinates (0-indexed relative to the code matrix).
         size: The width/height of the QR code matrix (e.g., 21 for version 1).
@@ -70,56 +95,55 @@ def is_structural(row, col, size, version):
     Returns:
         True if likely structural, False otherwise.
     """
-    # 1. Finder Patterns (Top-left, Top-right, Bottom-left) - 7x7 core + 1 separator
-    # Check 8x8 area to be safe and include separators
-    if (row < 8 and col < 8) or \
-       (row < 8 and col >= size - 8) or \
-       (row >= size - 8 and col < 8):
-        return True
-
-    # 2. Timing Patterns (Row 6 and Column 6, between finder patterns)
-    if (row == 6 and col >= 8 and col < size - 8) or \
-       (col == 6 and row >= 8 and row < size - 8):
-        return True
-
-    # 3. Alignment Patterns (Depend on version >= 2)
-    # Each alignment pattern is a 5x5 area. Check a slightly larger box (e.g., +/- 2) around center.
-    alignment_centers = get_alignment_pattern_locations(version)
-    for center_r, center_c in alignment_centers:
-        if abs(row - center_r) <= 2 and abs(col - center_c) <= 2:
-            return True
-
-    # 4. Format Information (Adjacent to finder patterns)
-    # Fixed positions relative to finder patterns. Size 15 modules total.
-    format_coords = set()
-    # Around top-left finder
-    for i in range(9): format_coords.add((8, i)) # Row 8, cols 0-8 (excluding timing pattern col 6)
-    for i in range(8): format_coords.add((i, 8)) # Col 8, rows 0-7 (excluding timing pattern row 6)
-    format_coords.discard((8,6)) # Discard timing pattern intersection safely
-    format_coords.discard((6,8)) # Discard timing pattern intersection safely
-
-    # Around top-right finder
-    for i in range(8): format_coords.add((8, size - 1 - i)) # Row 8, near top-right
-    # Around bottom-left finder
-    for i in range(8): format_coords.add((size - 1 - i, 8)) # Col 8, near bottom-left
-
-    if (row, col) in format_coords:
-        return True
+    return bool(compute_structural_mask(size, version)[row, col])
 
-    # 5. Version Information (Only for version >= 7)
-    # Two 3x6 blocks near top-right and bottom-left corners.
-    if version >= 7:
-        # Top-right block: rows 0-5, cols size-11 to size-9
-        if (row < 6 and col >= size - 11 and col < size - 8):
-            return True
-        # Bottom-left block: cols 0-5, rows size-11 to size-9
-        if (col < 6 and row >= size - 11 and row < size - 8):
-            return True
-
-    return False # Assume data/ECC otherwise
 
 # --- Layer Generation ---
 
+def _write_png_chunk(f, chunk_type, data):
+    """
+    Writes one PNG chunk (length, type, data, CRC) to an open binary file.
+    """
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def _encode_and_save(modules, box_size, border, filepath):
+    """
+    Streams a layer to disk as a 1-bit greyscale PNG with white marked transparent.
+    The scanline of every module row is packed once up front and fed to the compressor
+    box_size times, so the full-size image never exists in memory.
+    Args:
+        modules: (size, size) boolean array, True where the module is black.
+        box_size: Size of each QR module in pixels.
+        border: Width of the quiet zone border (in modules).
+        filepath: Destination path of the PNG file.
+    """
+    padded = np.pad(modules, border)
+    img_size = padded.shape[0] * box_size
+    # One scanline per module row: filter type 0 followed by the pixels packed MSB-first,
+    # 0 is black and 1 is white. Every module row repeats its scanline box_size times.
+    packed = np.packbits(~padded.repeat(box_size, axis=1), axis=1)
+    scanlines = np.pad(packed, ((0, 0), (1, 0)))
+    compressor = zlib.compressobj(6)
+
+    with open(filepath, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        # Width, height, bit depth 1, colour type 0 (greyscale), default compression/filter, no interlace
+        _write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', img_size, img_size, 1, 0, 0, 0, 0))
+        # Grey level 1 (white) is fully transparent
+        _write_png_chunk(f, b'tRNS', struct.pack('>H', 1))
+
+        for scanline in scanlines:
+            compressed = compressor.compress(scanline.tobytes() * box_size)
+            if compressed:
+                _write_png_chunk(f, b'IDAT', compressed)
+        _write_png_chunk(f, b'IDAT', compressor.flush())
+        _write_png_chunk(f, b'IEND', b'')
+
+
 def generate_visual_layered_qrs(data: str, n: int, k: int, output_dir: str, filename_prefix: str, box_size: int, border: int):
     """
     Generates n image layers that, when k are stacked, form a QR code.
@@ -131,6 +155,8 @@ def generate_visual_layered_qrs(data: str, n: int, k: int, output_dir: str, file
         filename_prefix: Prefix for output filenames.
         box_size: Size of each QR module in pixels.
         border: Width of the quiet zone border (in modules).
+    Returns:
+        The version of the generated QR code, or None if the layer images could not all be written.
     """
     if k > n or k < 1:
         raise ValueError("k must be between 1 and n")
@@ -145,7 +171,6 @@ def generate_visual_layered_qrs(data: str, n: int, k: int, output_dir: str, file
     qr.add_data(data)
     qr.make(fit=True)
     qr_version = qr.version
-    print(f"Target QR Code Version: {qr_version}")
 
     # Get the module matrix *without* the border for logic.
     # qr.modules gives a list of lists (rows) of booleans (True=black).
@@ -160,64 +185,42 @@ def generate_visual_layered_qrs(data: str, n: int, k: int, output_dir: str, file
     print(f"Generated target QR matrix of size: {matrix_size}x{matrix_size} (Version: {qr_version}) used for logic.")
 
 
-    # 2. Calculate final image dimensions (including border)
-    img_size = (matrix_size + 2 * border) * box_size
+    # 2. Classify modules once: structural modules are copied to every layer,
+    # black data modules are spread over a random subset of layers.
+    matrix_np = np.array(matrix, dtype=bool)
+    structural_mask = compute_structural_mask(matrix_size, qr_version)
+    black_structural = matrix_np & structural_mask
+    # White modules (structural or data) stay transparent on all layers, so only
+    # black data modules take part in the random layer assignment below.
+    data_cells = np.flatnonzero(matrix_np & ~structural_mask)
 
-    # 3. Create n transparent layer images
-    layers = []
-    for i in range(n):
-        layer_img = Image.new('RGBA', (img_size, img_size), (255, 255, 255, 0)) # Transparent background
-        layers.append((layer_img, ImageDraw.Draw(layer_img))) # Store image and its drawing context
-
-    # 4. Determine how many layers a black data module needs to be on
+    # 3. Determine how many layers a black data module needs to be on
     black_count_for_data = n - k + 1
     print(f"Each black data module will be drawn on {black_count_for_data} out of {n} layers.")
 
-    # 5. Iterate through target matrix (core modules) and distribute onto layers
-    all_layer_indices = list(range(n))
-    structural_module_count = 0
-    data_module_count = 0
-
-    for r_idx, row in enumerate(matrix):
-        for c_idx, module_is_black in enumerate(row):
-            # Determine if the module is structural (using 0-based index relative to matrix start)
-            # Pass the determined version to the structural check function
-            is_structural_module = is_structural(r_idx, c_idx, matrix_size, qr_version)
-
-            # Calculate pixel coordinates for the top-left of this module in the final image
-            # (including the border offset)
-            px_y = (border + r_idx) * box_size
-            px_x = (border + c_idx) * box_size
-
-            if module_is_black: # Target module is black
-                if is_structural_module:
-                    structural_module_count += 1
-                    # Structural & Black: Must be black on ALL n layers
-                    for _, draw_context in layers:
-                        draw_context.rectangle(
-                            [px_x, px_y, px_x + box_size -1 , px_y + box_size - 1], # Use -1 for exact box size pixels
-                            fill=(0, 0, 0, 255) # Black, fully opaque
-                        )
-                else:
-                    data_module_count += 1
-                    # Data & Black: Must be black on exactly `black_count_for_data` layers
-                    # Choose a random subset of layers for this module
-                    chosen_layer_indices = random.sample(all_layer_indices, black_count_for_data)
-                    for layer_idx in chosen_layer_indices:
-                        _, draw_context = layers[layer_idx]
-                        draw_context.rectangle(
-                            [px_x, px_y, px_x + box_size - 1, px_y + box_size - 1],
-                            fill=(0, 0, 0, 255) # Black, fully opaque
-                        )
-            else: # Target module is White (False)
-                # Structural & White: Must be white (transparent) on ALL layers.
-                # Data & White: Must be white (transparent) on ALL layers.
-                # Since layers start transparent, we do nothing here.
-                pass
+    # 4. Build the layer membership table: column j says which layers black data module j is drawn on
+    structural_module_count = int(np.count_nonzero(black_structural))
+    data_module_count = len(data_cells)
+
+    # Data & Black: Must be black on exactly `black_count_for_data` layers.
+    # Start every column with the first `black_count_for_data` layers set and shuffle
+    # each column independently in place (Fisher-Yates), giving a uniformly random subset per module.
+    rng = np.random.default_rng()
+    membership = np.zeros((n, data_module_count), dtype=bool)
+    membership[:black_count_for_data] = True
+    rng.permuted(membership, axis=0, out=membership)
+
+    # 5. Fill all layers in a single (layer, row, col) array:
+    # Data & Black: black on the layers picked in the membership table.
+    # Structural & Black: Must be black on ALL n layers, so it is broadcast across the layer axis.
+    module_layers = np.zeros((n, matrix_size * matrix_size), dtype=bool)
+    module_layers[:, data_cells] = membership
+    module_layers = module_layers.reshape(n, matrix_size, matrix_size)
+    module_layers |= black_structural
 
     print(f"Processed {structural_module_count} structural modules and {data_module_count} data/ECC modules.")
     if structural_module_count == 0 and matrix_size > 0:
-         print("Warning: No structural modules were identified. The `is_structural` function might need refinement for this QR version/layout.")
+         print("Warning: No structural modules were identified. The `compute_structural_mask` function might need refinement for this QR version/layout.")
 
 
     # 6. Save the layer images
@@ -228,11 +231,21 @@ def generate_visual_layered_qrs(data: str, n: int, k: int, output_dir: str, file
             print(f"Error creating output directory {output_dir}: {e}")
             return # Cannot save images
 
-    for i, (layer_img, _) in enumerate(layers):
-        filename = f"{filename_prefix}{i+1}_of_{n}.png"
-        filepath = os.path.join(output_dir, filename)
-        try:
-            layer_img.save(filepath, "PNG")
-            print(f"Saved: {filepath}")
-        except Exception as e:
-            print(f"Error saving image {filepath}: {e}")
+    # PNG encoding (zlib) releases the GIL, so the layers can be encoded in parallel threads
+    with ThreadPoolExecutor(max_workers=min(n, os.cpu_count() or 1)) as pool:
+        futures = []
+        for i in range(n):
+            filename = f"{filename_prefix}{i+1}_of_{n}.png"
+            filepath = os.path.join(output_dir, filename)
+            futures.append((filepath, pool.submit(_encode_and_save, module_layers[i], box_size, border, filepath)))
+
+        all_saved = True
+        for filepath, future in futures:
+            try:
+                future.result()
+                print(f"Saved: {filepath}")
+            except Exception as e:
+                print(f"Error saving image {filepath}: {e}")
+                all_saved = False
+
+    return qr_version if all_saved else None
@@ -33,7 +33,7 @@ def main():
     print(f"Saving images to: {args.output_dir}")
 
     try:
-        generate_visual_layered_qrs(
+        qr_version = generate_visual_layered_qrs(
             data=args.text,
             n=args.total_pieces,
             k=args.required_pieces,
@@ -42,7 +42,10 @@ def main():
             box_size=args.box_size,
             border=args.border
         )
-        print(f"Successfully generated {args.total_pieces} QR code layer images.")
+        if qr_version is None:
+            print("Error: Not all QR code layer images could be written.")
+        else:
+            print(f"Successfully generated {args.total_pieces} QR code layer images (QR version {qr_version}).")
     except Exception as e:
         print(f"An error occurred: {e}")
         # Consider adding more detailed error logging or traceback here